@@ -2,16 +2,25 @@
 # @formatter:off
 
 import os
+import atexit
+import glob
+import shutil
 
 from urllib import request
 from concurrent import futures
+import threading
+import subprocess
+import functools
+import itertools
 import pickle
+import json
 
 import jax
 from alphafold.data.tools import jackhmmer
 from alphafold.data import parsers
 from alphafold.data import pipeline
 from alphafold.common import protein
+from alphafold.common import residue_constants
 from alphafold.model import config
 from alphafold.model import model
 from alphafold.model import data
@@ -40,26 +49,44 @@ except:
 import tqdm.notebook
 TQDM_BAR_FORMAT = '{l_bar}{bar}| {n_fmt}/{total_fmt} [elapsed: {elapsed} remaining: {remaining}]'
 
+# input sanitization patterns, compiled once
+_RE_SEQ = re.compile("[^A-Z:/]")
+_RE_COLON = re.compile(":+")
+_RE_SLASH = re.compile("/+")
+_RE_JOB = re.compile(r"\W+")
+_RE_HOMO_BREAK = re.compile("[:/]+")
+# "$" also matches before a trailing newline, str.strip would not drop ":" in "2:\n"
+_RE_HOMO_EDGE = re.compile("^:+|:+$")
+_RE_HOMO = re.compile("[^0-9:]")
+_RE_TRIM = re.compile("[^0-9A-Z,-]")
+_RE_COMMA = re.compile(",+")
+
 #######################################################################################################################################
 # prep_inputs
 #######################################################################################################################################
 
-def prep_inputs(sequence, jobname="test", homooligomer="1", output_dir=None, clean=False, verbose=True):
-  # process inputs
-  sequence = str(sequence)
-  sequence = re.sub("[^A-Z:/]", "", sequence.upper())
-  sequence = re.sub(":+",":",sequence)
-  sequence = re.sub("/+","/",sequence)
-  sequence = re.sub("^[:/]+","",sequence)
-  sequence = re.sub("[:/]+$","",sequence)
-  jobname = re.sub(r'\W+', '', jobname)
-  homooligomer = str(homooligomer)
-  homooligomer = re.sub("[:/]+",":",homooligomer)
-  homooligomer = re.sub("^[:/]+","",homooligomer)
-  homooligomer = re.sub("[:/]+$","",homooligomer)
+def _clean_sequence(sequence):
+  '''keep residues and chain/segment breaks, collapse repeated breaks and drop them at the ends'''
+  sequence = _RE_SEQ.sub("", str(sequence).upper())
+  sequence = _RE_COLON.sub(":", sequence)
+  # only [A-Z:/] is left at this point, so strip() matches the old anchored patterns
+  return _RE_SLASH.sub("/", sequence).strip(":/")
 
+def _clean_homooligomer(homooligomer):
+  homooligomer = _RE_HOMO_BREAK.sub(":", str(homooligomer))
+  homooligomer = _RE_HOMO_EDGE.sub("", homooligomer)
   if len(homooligomer) == 0: homooligomer = "1"
-  homooligomer = re.sub("[^0-9:]", "", homooligomer)
+  return _RE_HOMO.sub("", homooligomer)
+
+def _clean_trim(trim):
+  trim = _RE_TRIM.sub("", trim.upper())
+  return _RE_COMMA.sub(",", trim).strip(",")
+
+def prep_inputs(sequence, jobname="test", homooligomer="1", output_dir=None, clean=False, verbose=True):
+  # process inputs
+  sequence = _clean_sequence(sequence)
+  jobname = _RE_JOB.sub("", jobname)
+  homooligomer = _clean_homooligomer(homooligomer)
 
   # define inputs
   I = {"ori_sequence":sequence,
@@ -90,12 +117,18 @@ def prep_inputs(sequence, jobname="test", homooligomer="1", output_dir=None, cle
     I["output_dir"] = 'prediction_' + jobname + '_' + cf.get_hash(I["full_sequence"])[:5]
   else:
     I["output_dir"] = output_dir
-  os.makedirs(I["output_dir"], exist_ok=True)
-    
+
   # delete existing files in working directory
-  if clean:
-    for f in os.listdir(I["output_dir"]):
-      os.remove(os.path.join(I["output_dir"], f))
+  if clean and os.path.isdir(I["output_dir"]):
+    if output_dir is None:
+      # the generated prediction_<jobname>_<hash> directory only holds our own outputs
+      shutil.rmtree(I["output_dir"])
+    else:
+      # a caller supplied directory may hold other data, only remove its top-level files
+      for entry in os.scandir(I["output_dir"]):
+        if not entry.is_dir(follow_symlinks=False):
+          os.unlink(entry.path)
+  os.makedirs(I["output_dir"], exist_ok=True)
 
   if verbose and len(I["full_sequence"]) > 1400:
     print(f"WARNING: For a typical Google-Colab-GPU (16G) session, the max total length is ~1400 residues. You are at {len(I['full_sequence'])}!")
@@ -112,107 +145,226 @@ def prep_inputs(sequence, jobname="test", homooligomer="1", output_dir=None, cle
 # prep_msa
 #######################################################################################################################################
 
-def run_jackhmmer(sequence, prefix, jackhmmer_binary_path='jackhmmer', verbose=True):
+# worker threads shared by the mirror probes and database searches of every run_jackhmmer call,
+# one per probe and one per search, so a search never queues behind a probe that is still running
+_POOL = futures.ThreadPoolExecutor(max_workers=6)
+atexit.register(_POOL.shutdown)
+
+# sequences are handled as ascii uint8 arrays wherever numpy is used, and turned into
+# residue ids with a single lookup (see _HHBLITS_AA_LUT) instead of per character loops
+def _seq_to_array(seq):
+  '''encode a sequence as a [L] uint8 array'''
+  return np.frombuffer(seq.encode("ascii"), dtype=np.uint8)
+
+def _msa_to_array(msa):
+  '''encode aligned (equal length) sequences as a [N,L] uint8 array'''
+  L = len(msa[0]) if len(msa) > 0 else 0
+  if any(len(seq) != L for seq in msa):
+    raise ValueError("ERROR: all sequences of an msa must have the same length")
+  return _seq_to_array("".join(msa)).reshape(len(msa), L)
+
+def _array_to_msa(msa_arr):
+  '''decode a [N,L] uint8 array back to a tuple of sequences'''
+  return tuple(row.tobytes().decode("ascii") for row in msa_arr)
+
+def _savez_atomic(path, **arrays):
+  '''np.savez to a temporary name and rename it into place, so readers never see a partial file'''
+  tmp_path = path[:-len(".npz")] + ".tmp.npz"
+  np.savez(tmp_path, **arrays)
+  os.replace(tmp_path, path)
+
+def _dump_json_atomic(obj, path):
+  '''json.dump to a temporary name and rename it into place, so readers never see a partial file'''
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "w") as f:
+    json.dump(obj, f)
+  os.replace(tmp_path, path)
+
+def _filter_redundant(seqs, seq_id=0.9, block=256):
+  '''
+  in-process version of `hhfilter -id`, following its rules: the query is always kept, the other
+  sequences are visited from most to fewest residues, and a sequence is dropped when it differs
+  from a kept one at fewer than (1-[seq_id]) of the residues of the shorter of the two
+  (mismatches only count where both have a residue, so exactly [seq_id] identity is kept)
+  ----- inputs -----
+  seqs: list of aligned (equal length) sequences, the first one is the query
+  ----- outputs -----
+  ok: sorted indices of the kept sequences
+  '''
+  if len(seqs) == 0:
+    return []
+  msa = _msa_to_array(seqs)
+  is_res = msa != ord("-")
+  num_res = is_res.sum(-1)
+  order = np.append(0, np.argsort(-num_res[1:], kind="stable") + 1)
+  max_diff_frac = 0.9999 - seq_id
+
+  # kept rows are appended to preallocated buffers and compared block by block,
+  # stopping at the first block that contains a near identical sequence
+  kept_msa = np.empty_like(msa)
+  kept_is_res = np.empty_like(is_res)
+  kept_num_res = np.empty_like(num_res)
+  num_kept = 0
+  seen = set()
+  ok = []
+  for i in order:
+    # an exact copy of an earlier sequence is redundant no matter what that one was compared to
+    if seqs[i] in seen: continue
+    seen.add(seqs[i])
+    redundant = False
+    for b in range(0, num_kept, block):
+      e = min(b + block, num_kept)
+      diff = ((kept_msa[b:e] != msa[i]) & kept_is_res[b:e] & is_res[i]).sum(-1)
+      if (diff <= max_diff_frac * np.minimum(kept_num_res[b:e], num_res[i])).any():
+        redundant = True
+        break
+    if not redundant:
+      kept_msa[num_kept] = msa[i]
+      kept_is_res[num_kept] = is_res[i]
+      kept_num_res[num_kept] = num_res[i]
+      num_kept += 1
+      ok.append(int(i))
+  return sorted(ok)
+
+def _hhfilter(seqs, hhfilter_loc="hhfilter", seq_id=90):
+  '''run `hhfilter -id` on the sequences through stdin/stdout and return the indices it keeps'''
+  fas = "".join(f">{n}\n{seq}\n" for n,seq in enumerate(seqs)).encode()
+  out = subprocess.run([hhfilter_loc, "-v", "0", "-maxseq", "1000000", "-id", str(seq_id),
+                        "-i", "stdin", "-o", "stdout"],
+                       input=fas, stdout=subprocess.PIPE, check=True).stdout
+  return [int(line[1:]) for line in out.decode().splitlines() if line.startswith(">")]
+
+def run_jackhmmer(sequence, prefix, jackhmmer_binary_path='jackhmmer', verbose=True, cache=None,
+                  max_parallel_searches=1):
+  '''
+  search uniref90, smallbfd and mgnify with jackhmmer, results are cached in {prefix}.jackhmmer.npz/json
+  cache: optional dict the results are also kept in, so repeated calls within one caller skip the disk cache
+  max_parallel_searches: how many databases to search at once; each running search keeps its
+                         streamed chunk (~1GB) in /tmp/ramdisk, so the default is one at a time
+  '''
+
+  cache_key = (sequence, prefix, jackhmmer_binary_path)
+  if cache is not None and cache_key in cache:
+    return cache[cache_key]
 
   fasta_path = f"{prefix}.fasta"
   with open(fasta_path, 'wt') as f:
     f.write(f'>query\n{sequence}')
 
-  pickled_msa_path = f"{prefix}.jackhmmer.pickle"
-  if os.path.isfile(pickled_msa_path):
-    msas_dict = pickle.load(open(pickled_msa_path,"rb"))
-    msas, deletion_matrices, names = (msas_dict[k] for k in ['msas', 'deletion_matrices', 'names'])
-    full_msa = []
-    for msa in msas:
-      full_msa += msa
+  # msas and deletion matrices are cached as arrays, the names in a json sidecar
+  msa_cache_path = f"{prefix}.jackhmmer.npz"
+  names_cache_path = f"{prefix}.jackhmmer.json"
+  if os.path.isfile(msa_cache_path) and os.path.isfile(names_cache_path):
+    with open(names_cache_path) as f:
+      names = [tuple(db_names) for db_names in json.load(f)]
+    with np.load(msa_cache_path) as msa_cache:
+      msas = [_array_to_msa(msa_cache[f"msa{i}"]) for i in range(len(names))]
+      deletion_matrices = [tuple(msa_cache[f"mtx{i}"].tolist()) for i in range(len(names))]
   else:
     # --- Find the closest source ---
     test_url_pattern = 'https://storage.googleapis.com/alphafold-colab{:s}/latest/uniref90_2021_03.fasta.1'
-    ex = futures.ThreadPoolExecutor(3)
     def fetch(source):
-      request.urlretrieve(test_url_pattern.format(source))
-      return source
-    fs = [ex.submit(fetch, source) for source in ['', '-europe', '-asia']]
+      # only the response headers are needed to find the fastest mirror
+      req = request.Request(test_url_pattern.format(source), method='HEAD')
+      with request.urlopen(req, timeout=10):
+        return source
+    fs = [_POOL.submit(fetch, source) for source in ['', '-europe', '-asia']]
     source = None
     for f in futures.as_completed(fs):
       source = f.result()
-      ex.shutdown()
       break
+    for f in fs:
+      f.cancel()
       
-    dbs = []
-
+    # --- Search the databases ---
     num_jackhmmer_chunks = {'uniref90': 59, 'smallbfd': 17, 'mgnify': 71}
+    jackhmmer_db_files = {'uniref90': 'uniref90_2021_03.fasta',
+                          'smallbfd': 'bfd-first_non_consensus_sequences.fasta',
+                          'mgnify': 'mgy_clusters_2019_05.fasta'}
+    jackhmmer_z_values = {'uniref90': 135301051, 'smallbfd': 65984053, 'mgnify': 304820129}
     total_jackhmmer_chunks = sum(num_jackhmmer_chunks.values())
     disable_tqdm = not verbose
     with tqdm.notebook.tqdm(total=total_jackhmmer_chunks, bar_format=TQDM_BAR_FORMAT, disable=disable_tqdm) as pbar:
+      pbar_lock = threading.Lock()
       def jackhmmer_chunk_callback(i):
-        pbar.update(n=1)
-
-      pbar.set_description('Searching uniref90')
-      jackhmmer_uniref90_runner = jackhmmer.Jackhmmer(
-          binary_path=jackhmmer_binary_path,
-          database_path=f'https://storage.googleapis.com/alphafold-colab{source}/latest/uniref90_2021_03.fasta',
-          get_tblout=True,
-          num_streamed_chunks=num_jackhmmer_chunks['uniref90'],
-          streaming_callback=jackhmmer_chunk_callback,
-          z_value=135301051)
-      dbs.append(('uniref90', jackhmmer_uniref90_runner.query(fasta_path)))
-
-      pbar.set_description('Searching smallbfd')
-      jackhmmer_smallbfd_runner = jackhmmer.Jackhmmer(
-          binary_path=jackhmmer_binary_path,
-          database_path=f'https://storage.googleapis.com/alphafold-colab{source}/latest/bfd-first_non_consensus_sequences.fasta',
-          get_tblout=True,
-          num_streamed_chunks=num_jackhmmer_chunks['smallbfd'],
-          streaming_callback=jackhmmer_chunk_callback,
-          z_value=65984053)
-      dbs.append(('smallbfd', jackhmmer_smallbfd_runner.query(fasta_path)))
-
-      pbar.set_description('Searching mgnify')
-      jackhmmer_mgnify_runner = jackhmmer.Jackhmmer(
-          binary_path=jackhmmer_binary_path,
-          database_path=f'https://storage.googleapis.com/alphafold-colab{source}/latest/mgy_clusters_2019_05.fasta',
-          get_tblout=True,
-          num_streamed_chunks=num_jackhmmer_chunks['mgnify'],
-          streaming_callback=jackhmmer_chunk_callback,
-          z_value=304820129)
-      dbs.append(('mgnify', jackhmmer_mgnify_runner.query(fasta_path)))
+        with pbar_lock:
+          pbar.update(n=1)
+
+      def search(db_name):
+        jackhmmer_runner = jackhmmer.Jackhmmer(
+            binary_path=jackhmmer_binary_path,
+            database_path=f'https://storage.googleapis.com/alphafold-colab{source}/latest/{jackhmmer_db_files[db_name]}',
+            get_tblout=True,
+            num_streamed_chunks=num_jackhmmer_chunks[db_name],
+            streaming_callback=jackhmmer_chunk_callback,
+            z_value=jackhmmer_z_values[db_name])
+        return jackhmmer_runner.query(fasta_path)
+
+      if max_parallel_searches <= 1:
+        dbs = []
+        for db_name in num_jackhmmer_chunks:
+          pbar.set_description(f'Searching {db_name}')
+          dbs.append((db_name, search(db_name)))
+      else:
+        # every running search streams its chunks into /tmp/ramdisk, so bound how many run at once
+        slots = threading.BoundedSemaphore(max_parallel_searches)
+        def bounded_search(db_name):
+          with slots:
+            return search(db_name)
+        pbar.set_description('Searching ' + ', '.join(num_jackhmmer_chunks))
+        db_fs = {db_name: _POOL.submit(bounded_search, db_name) for db_name in num_jackhmmer_chunks}
+        try:
+          # keep the database order fixed, independent of which search finishes first
+          dbs = [(db_name, f.result()) for db_name, f in db_fs.items()]
+        except BaseException:
+          # don't leave searches streaming chunks into /tmp/ramdisk behind, a retry would race them
+          for f in db_fs.values():
+            f.cancel()
+          futures.wait(db_fs.values())
+          raise
 
     # --- Extract the MSAs and visualize ---
     # Extract the MSAs from the Stockholm files.
-    # NB: deduplication happens later in pipeline.make_msa_features.
+    # NB: deduplication happens later in _make_msa_features (prep_feats).
 
     mgnify_max_hits = 501
     msas = []
     deletion_matrices = []
     names = []
     for db_name, db_results in dbs:
-      unsorted_results = []
+      unsorted_msas, unsorted_deletion_matrices, unsorted_names, unsorted_e_values = [], [], [], []
       for i, result in enumerate(db_results):
         msa, deletion_matrix, target_names = parsers.parse_stockholm(result['sto'])
         e_values_dict = parsers.parse_e_values_from_tblout(result['tbl'])
-        e_values = [e_values_dict[t.split('/')[0]] for t in target_names]
-        zipped_results = zip(msa, deletion_matrix, target_names, e_values)
-        if i != 0:
-          # Only take query from the first chunk
-          zipped_results = [x for x in zipped_results if x[2] != 'query']
-        unsorted_results.extend(zipped_results)
-      sorted_by_evalue = sorted(unsorted_results, key=lambda x: x[3])
-      db_msas, db_deletion_matrices, db_names, _ = zip(*sorted_by_evalue)
+        # Only take query from the first chunk
+        keep = [n for n, t in enumerate(target_names) if i == 0 or t != 'query']
+        unsorted_msas.extend(msa[n] for n in keep)
+        unsorted_deletion_matrices.extend(deletion_matrix[n] for n in keep)
+        unsorted_names.extend(target_names[n] for n in keep)
+        unsorted_e_values.extend(e_values_dict[target_names[n].split('/')[0]] for n in keep)
+
+      # sort by e-value (ties keep their original order); for mgnify only the top hits are kept
+      e_values = np.fromiter(unsorted_e_values, dtype=np.float64, count=len(unsorted_e_values))
+      max_hits = mgnify_max_hits if db_name == 'mgnify' else len(e_values)
+      order = np.argsort(e_values, kind='stable')[:max_hits]
+      db_msas = tuple(unsorted_msas[n] for n in order)
+      db_deletion_matrices = tuple(unsorted_deletion_matrices[n] for n in order)
+      db_names = tuple(unsorted_names[n] for n in order)
       if db_msas:
-        if db_name == 'mgnify':
-          db_msas = db_msas[:mgnify_max_hits]
-          db_deletion_matrices = db_deletion_matrices[:mgnify_max_hits]
-          db_names = db_names[:mgnify_max_hits]
         msas.append(db_msas)
         deletion_matrices.append(db_deletion_matrices)
         names.append(db_names)
         msa_size = len(set(db_msas))
         print(f'{msa_size} Sequences Found in {db_name}')
 
-      pickle.dump({"msas":msas,
-                   "deletion_matrices":deletion_matrices,
-                   "names":names}, open(pickled_msa_path,"wb"))
+    # both files are replaced atomically and the sidecar goes last,
+    # so its presence means the npz next to it is complete
+    _savez_atomic(msa_cache_path,
+                  **{f"msa{i}": _msa_to_array(msa) for i, msa in enumerate(msas)},
+                  **{f"mtx{i}": np.asarray(mtx, dtype=np.uint16) for i, mtx in enumerate(deletion_matrices)})
+    _dump_json_atomic(names, names_cache_path)
+  if cache is not None:
+    cache[cache_key] = (msas, deletion_matrices, names)
   return msas, deletion_matrices, names
 
 def prep_msa(I, msa_method="mmseqs2", add_custom_msa=False, msa_format="fas",
@@ -220,15 +372,22 @@ def prep_msa(I, msa_method="mmseqs2", add_custom_msa=False, msa_format="fas",
              hhfilter_loc="hhfilter", reformat_loc="reformat.pl", TMP_DIR="tmp",
              custom_msa=None, precomputed=None,
              mmseqs_host_url="https://a3m.mmseqs.com",
-             verbose=True):
+             verbose=True, max_parallel_searches=1):
   
   # make temp directory
   os.makedirs(TMP_DIR, exist_ok=True)
 
+  # tmp file prefixes, hashed once and shared by the unpaired and paired searches
+  full_hash = cf.get_hash(I["sequence"])
+  seq_hashes = [cf.get_hash(seq) for seq in I["seqs"]]
+
   # clear previous inputs
   I["msas"] = []
   I["deletion_matrices"] = []
 
+  # run_jackhmmer results shared by the unpaired and paired branches of this call
+  jackhmmer_cache = {}
+
   if add_custom_msa:
     if IN_COLAB:
       print(f"upload custom msa in '{msa_format}' format")
@@ -279,20 +438,29 @@ def prep_msa(I, msa_method="mmseqs2", add_custom_msa=False, msa_format="fas",
         for n,val in zip(ns,vals): _blank[n] = val
       else: _blank[ns] = vals
       if mode == "seq": return "".join(_blank)
-      if mode == "mtx": return sum(_blank,[])
+      if mode == "mtx": return list(itertools.chain.from_iterable(_blank))
+
+    _offsets = np.cumsum([0] + I["lengths"])
+    def _pad_block(ns,seqs,mtxs):
+      '''_pad for all rows at once: chains [ns] are filled from [seqs]/[mtxs], the rest are gaps'''
+      num = len(seqs[0])
+      seq_arr = np.full((num,_offsets[-1]), ord("-"), dtype=np.uint8)
+      mtx_arr = np.zeros((num,_offsets[-1]), dtype=np.uint16)
+      for n,seq,mtx in zip(ns,seqs,mtxs):
+        seq_arr[:,_offsets[n]:_offsets[n+1]] = _msa_to_array(seq)
+        mtx_arr[:,_offsets[n]:_offsets[n+1]] = mtx
+      return list(_array_to_msa(seq_arr)), mtx_arr.tolist()
 
     if len(I["seqs"]) == 1 or "unpaired" in pair_mode:
       # gather msas
       if msa_method == "mmseqs2":
-        prefix = cf.get_hash(I["sequence"])
-        prefix = os.path.join(TMP_DIR,prefix)
+        prefix = os.path.join(TMP_DIR,full_hash)
         print(f"running mmseqs2")
         A3M_LINES = cf.run_mmseqs2(I["seqs"], prefix, use_filter=True, host_url=mmseqs_host_url)
 
       for n, seq in enumerate(I["seqs"]):
         # tmp directory
-        prefix = cf.get_hash(seq)
-        prefix = os.path.join(TMP_DIR,prefix)
+        prefix = os.path.join(TMP_DIR,seq_hashes[n])
 
         if msa_method == "mmseqs2":
           # run mmseqs2
@@ -303,7 +471,8 @@ def prep_msa(I, msa_method="mmseqs2", add_custom_msa=False, msa_format="fas",
         elif msa_method == "jackhmmer":
           print(f"running jackhmmer on seq_{n}")
           # run jackhmmer
-          msas_, mtxs_, names_ = ([sum(x,())] for x in run_jackhmmer(seq, prefix))
+          msas_, mtxs_, names_ = ([sum(x,())] for x in run_jackhmmer(seq, prefix, cache=jackhmmer_cache,
+                                                                     max_parallel_searches=max_parallel_searches))
         
         # pad sequences
         for msa_,mtx_ in zip(msas_,mtxs_):
@@ -320,8 +489,7 @@ def prep_msa(I, msa_method="mmseqs2", add_custom_msa=False, msa_format="fas",
       print("attempting to pair some sequences...")
 
       if msa_method == "mmseqs2":
-        prefix = cf.get_hash(I["sequence"])
-        prefix = os.path.join(TMP_DIR,prefix)
+        prefix = os.path.join(TMP_DIR,full_hash)
         print(f"running mmseqs2_noenv_nofilter on all seqs")
         A3M_LINES = cf.run_mmseqs2(I["seqs"], prefix, use_env=False, use_filter=False, host_url=mmseqs_host_url)
 
@@ -329,7 +497,7 @@ def prep_msa(I, msa_method="mmseqs2", add_custom_msa=False, msa_format="fas",
       for a in range(len(I["seqs"])):
         print(f"prepping seq_{a}")
         _seq = I["seqs"][a]
-        _prefix = os.path.join(TMP_DIR,cf.get_hash(_seq))
+        _prefix = os.path.join(TMP_DIR,seq_hashes[a])
 
         if msa_method == "mmseqs2":
           a3m_lines = A3M_LINES[a]
@@ -338,7 +506,8 @@ def prep_msa(I, msa_method="mmseqs2", add_custom_msa=False, msa_format="fas",
                                                filter_cov=pair_cov/100)
 
         elif msa_method == "jackhmmer":
-          _msas, _mtxs, _names = run_jackhmmer(_seq, _prefix)
+          _msas, _mtxs, _names = run_jackhmmer(_seq, _prefix, cache=jackhmmer_cache,
+                                                     max_parallel_searches=max_parallel_searches)
           _msa, _mtx, _lab = pairmsa.get_uni_jackhmmer(_msas[0], _mtxs[0], _names[0],
                                                        filter_qid=pair_qid/100,
                                                        filter_cov=pair_cov/100)
@@ -359,23 +528,20 @@ def prep_msa(I, msa_method="mmseqs2", add_custom_msa=False, msa_format="fas",
               _seq_a, _seq_b, _mtx_a, _mtx_b = (*O[a][b]["seq"],*O[a][b]["mtx"])
 
               # filter to remove redundant sequences
-              ok = []
-              with open(f"{TMP_DIR}/tmp.fas","w") as fas_file:
-                fas_file.writelines([f">{n}\n{a+b}\n" for n,(a,b) in enumerate(zip(_seq_a,_seq_b))])
-              os.system(f"{hhfilter_loc} -maxseq 1000000 -i {TMP_DIR}/tmp.fas -o {TMP_DIR}/tmp.id90.fas -id 90")
-              for line in open(f"{TMP_DIR}/tmp.id90.fas","r"):
-                if line.startswith(">"): ok.append(int(line[1:]))
+              # (hhfilter_loc=None uses the in-process filter instead of the binary)
+              _seq_ab = [s_a+s_b for s_a,s_b in zip(_seq_a,_seq_b)]
+              if hhfilter_loc is None:
+                ok = _filter_redundant(_seq_ab, seq_id=0.9)
+              else:
+                ok = _hhfilter(_seq_ab, hhfilter_loc, seq_id=90)
                 
               if verbose:      
                 print(f"found {len(_seq_a)} pairs ({len(ok)} after filtering)")
 
               if len(_seq_a) > 0:
-                msa,mtx = [I["sequence"]],[[0]*len(I["sequence"])]
-                for s_a,s_b,m_a,m_b in zip(_seq_a, _seq_b, _mtx_a, _mtx_b):
-                  msa.append(_pad([a,b],[s_a,s_b],"seq"))
-                  mtx.append(_pad([a,b],[m_a,m_b],"mtx"))
-                I["msas"].append(msa)
-                I["deletion_matrices"].append(mtx)
+                msa,mtx = _pad_block([a,b],[_seq_a,_seq_b],[_mtx_a,_mtx_b])
+                I["msas"].append([I["sequence"]] + msa)
+                I["deletion_matrices"].append([[0]*len(I["sequence"])] + mtx)
       
   # save MSA as pickle
   pickle.dump({"msas":I["msas"],"deletion_matrices":I["deletion_matrices"]},
@@ -437,9 +603,9 @@ def trim_inputs(trim, msas, deletion_matrices, ori_seq=None, inverse=False):
   # trim MSA
   mod_msas, mod_mtxs = [],[]
   for msa, mtx in zip(msas, deletion_matrices):
-    mod_msa = np.delete([list(s) for s in msa], trim_set, 1)
-    ok = (mod_msa != "-").sum(-1) > 0
-    mod_msas.append(["".join(s) for s in mod_msa[ok]])
+    mod_msa = np.delete(_msa_to_array(msa), trim_set, 1)
+    ok = (mod_msa != ord("-")).any(-1)
+    mod_msas.append(list(_array_to_msa(mod_msa[ok])))
     mod_mtx = np.asarray(mtx)[ok]
     mod_mtxs.append(np.delete(mod_mtx, trim_set, 1).tolist())
 
@@ -468,16 +634,16 @@ def trim_inputs(trim, msas, deletion_matrices, ori_seq=None, inverse=False):
 def cov_qid_filter(msas, deletion_matrices, ori_seq=None, cov=0, qid=0):
   if ori_seq is None: ori_seq = msas[0][0]
   seqs = ori_seq.replace("/","").split(":")
-  ref_seq_ = np.array(list("".join(seqs)))
+  ref_seq_ = _seq_to_array("".join(seqs))
 
   new_msas,new_mtxs = [],[]
   L = np.asarray([len(seq) for seq in seqs])
   Ln = np.cumsum(np.append(0,L))
   for msa, mtx in zip(msas, deletion_matrices):
-    msa_ = np.asarray([list(seq) for seq in msa])
+    msa_ = _msa_to_array(msa)
 
     # coverage (non-gap characters)
-    cov_ = msa_ != "-"
+    cov_ = msa_ != ord("-")
     # sequence identity to query
     qid_ = msa_ == ref_seq_
 
@@ -500,10 +666,7 @@ def cov_qid_filter(msas, deletion_matrices, ori_seq=None, cov=0, qid=0):
   return {"msas":new_msas, "deletion_matrices":new_mtxs}
 
 def prep_filter(I, trim="", trim_inverse=False, cov=0, qid=0, verbose=True):
-  trim = re.sub("[^0-9A-Z,-]", "", trim.upper())
-  trim = re.sub(",+",",",trim)
-  trim = re.sub("^[,]+","",trim)
-  trim = re.sub("[,]+$","",trim)
+  trim = _clean_trim(trim)
   if trim != "" or cov > 0 or qid > 0:
     mod_I = dict(I)
     
@@ -530,6 +693,39 @@ def prep_filter(I, trim="", trim_inverse=False, cov=0, qid=0, verbose=True):
 # prep features
 #######################################################################################################################################
 
+# ascii code -> hhblits residue id, -1 for characters HHBLITS_AA_TO_ID does not know
+_HHBLITS_AA_LUT = np.full(256, -1, dtype=np.int32)
+for _aa, _id in residue_constants.HHBLITS_AA_TO_ID.items():
+  _HHBLITS_AA_LUT[ord(_aa)] = _id
+
+def _make_msa_features(msas, deletion_matrices):
+  '''
+  same features as pipeline.make_msa_features (msa, deletion_matrix_int, num_alignments),
+  but tokenizes all deduplicated rows with one lookup into [_HHBLITS_AA_LUT]
+  '''
+  if not msas:
+    raise ValueError("At least one MSA must be provided.")
+  seen, rows, mtxs = set(), [], []
+  for msa_index, msa in enumerate(msas):
+    if not msa:
+      raise ValueError(f"MSA {msa_index} must contain at least one sequence.")
+    if len(deletion_matrices[msa_index]) != len(msa):
+      raise ValueError(f"MSA {msa_index} has {len(msa)} sequences but "
+                       f"{len(deletion_matrices[msa_index])} deletion matrix rows.")
+    for seq, mtx in zip(msa, deletion_matrices[msa_index]):
+      if seq in seen: continue
+      seen.add(seq)
+      rows.append(seq)
+      mtxs.append(mtx)
+  int_msa = _HHBLITS_AA_LUT[_msa_to_array(rows)]
+  if (int_msa < 0).any():
+    unknown = sorted(set("".join(rows)) - set(residue_constants.HHBLITS_AA_TO_ID))
+    raise ValueError(f"MSA contains unknown residues: {unknown}")
+  num_res = len(msas[0][0])
+  return {"msa": int_msa,
+          "deletion_matrix_int": np.array(mtxs, dtype=np.int32),
+          "num_alignments": np.array([len(rows)] * num_res, dtype=np.int32)}
+
 def prep_feats(I, clean=False):
   def _placeholder_template_feats(num_templates_, num_res_):
     return {
@@ -541,8 +737,8 @@ def prep_feats(I, clean=False):
     }
   # delete old files
   if clean:
-    for f in os.listdir(I["output_dir"]):
-      if "rank_" in f: os.remove(os.path.join(I["output_dir"], f))
+    for f in glob.glob(os.path.join(glob.escape(I["output_dir"]), "*rank_*")):
+      os.unlink(f)
         
   if len(I["msas"]) == 0:
     print("WARNING: no MSA found, switching to 'single_sequence' mode")
@@ -557,7 +753,7 @@ def prep_feats(I, clean=False):
   num_res = len(I["full_sequence"])
   feature_dict = {}
   feature_dict.update(pipeline.make_sequence_features(I["full_sequence"], 'test', num_res))
-  feature_dict.update(pipeline.make_msa_features(msas_mod, deletion_matrices=deletion_matrices_mod))
+  feature_dict.update(_make_msa_features(msas_mod, deletion_matrices_mod))
   feature_dict.update(_placeholder_template_feats(0, num_res))
 
   # set chainbreaks
@@ -611,6 +807,29 @@ def clear_mem(device=None):
     for buf in backend.live_buffers():
       buf.delete()
 
+@functools.partial(jax.jit, static_argnums=2)
+def _summarize_distogram(dist_logits, bin_edges, num_res):
+  '''distance and contact maps computed in a single jitted pass on device'''
+  dist_logits = dist_logits[:num_res,:num_res]
+  dist_bins = jax.numpy.append(0,bin_edges)
+  dist_mtx = dist_bins[dist_logits.argmax(-1)]
+  contact_mtx = jax.numpy.where(dist_bins < 8, jax.nn.softmax(dist_logits), 0).sum(-1)
+  return dist_mtx, contact_mtx
+
+def write_pdbs(pdbs, flags=0):
+  '''
+  write [(path, pdb_lines), ...] with plain os.open/os.write, skipping the text io layer
+  [flags] are added to the open flags, e.g. os.O_DSYNC for slow network mounted output dirs
+  '''
+  for path, pdb_lines in pdbs:
+    buf = memoryview(pdb_lines.encode())
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | flags, 0o666)
+    try:
+      while buf:
+        buf = buf[os.write(fd, buf):]
+    finally:
+      os.close(fd)
+
 OPT_DEFAULT = {"N":None, "L":None,
                "use_ptm":True, "use_turbo":True,
                "max_recycles":3, "tol":0, "num_ensemble":1,
@@ -662,15 +881,16 @@ def run_alphafold(feature_dict, opt=None, runner=None, num_models=5, num_samples
     if N > N_:
       if verbose:
         print(f"whhhaaa... too many sequences ({N}) subsampling to {N_}")
-      np.random.seed(random_seed)
-      idx = np.append(0,np.random.permutation(np.arange(1,N)))[:N_]
-      F_ = {}
-      F_["msa"] = F["msa"][idx]
-      F_["deletion_matrix_int"] = F["deletion_matrix_int"][idx]
-      F_["num_alignments"] = np.full_like(F["num_alignments"],N_)
-      for k in F.keys():
-        if k not in F_: F_[k] = F[k]      
-      return F_
+      # always keep the query, sample the rest without shuffling all N rows
+      rng = np.random.default_rng(random_seed)
+      idx = np.empty(N_, dtype=np.int64)
+      idx[0] = 0
+      idx[1:] = rng.choice(N-1, size=N_-1, replace=False) + 1
+      return {**F,
+              "msa": F["msa"][idx],
+              "deletion_matrix_int": F["deletion_matrix_int"][idx],
+              # read-only broadcast view, the features are only converted to tensors downstream
+              "num_alignments": np.broadcast_to(F["num_alignments"].dtype.type(N_), F["num_alignments"].shape)}
     else:
       return F
 
@@ -684,19 +904,19 @@ def run_alphafold(feature_dict, opt=None, runner=None, num_models=5, num_samples
           for k,v in d.items(): setattr(self, k, to_np(v))
       return dict2obj(c.__dict__)
 
-    dist_bins = jax.numpy.append(0,prediction_result["distogram"]["bin_edges"])
-    dist_logits = prediction_result["distogram"]["logits"][:num_res,:][:,:num_res]
-    dist_mtx = dist_bins[dist_logits.argmax(-1)]
-    contact_mtx = jax.nn.softmax(dist_logits)[:,:,dist_bins < 8].sum(-1)
+    dist_mtx, contact_mtx = (to_np(x) for x in
+      _summarize_distogram(prediction_result["distogram"]["logits"],
+                           prediction_result["distogram"]["bin_edges"], num_res))
 
+    # plddt stays on the host in float64, it decides the ranking and the pdb b-factors
     b_factors = prediction_result['plddt'][:,None] * prediction_result['structure_module']['final_atom_mask']
     p = protein.from_prediction(processed_feature_dict, prediction_result, b_factors=b_factors)  
     plddt = prediction_result['plddt'][:num_res]
     out = {"unrelaxed_protein": class_to_np(p),
            "plddt": to_np(plddt),
            "pLDDT": to_np(plddt.mean()),
-           "dists": to_np(dist_mtx),
-           "adj": to_np(contact_mtx),
+           "dists": dist_mtx,
+           "adj": contact_mtx,
            "recycles":to_np(r),
            "tol":to_np(t)}
     if "ptm" in prediction_result:
@@ -730,8 +950,7 @@ def run_alphafold(feature_dict, opt=None, runner=None, num_models=5, num_samples
       fig = cf.plot_protein(o['unrelaxed_protein'], Ls=feature_dict["Ls"], dpi=100)
       plt.show()  
     tmp_pdb_path = os.path.join(feature_dict["output_dir"],f'unranked_{key}_unrelaxed.pdb')
-    pdb_lines = protein.to_pdb(o['unrelaxed_protein'])
-    with open(tmp_pdb_path, 'w') as f: f.write(pdb_lines)
+    write_pdbs([(tmp_pdb_path, protein.to_pdb(o['unrelaxed_protein']))])
   
   disable_tqdm = not verbose
   with tqdm.notebook.tqdm(total=total, bar_format=TQDM_BAR_FORMAT, disable=disable_tqdm) as pbar:
@@ -804,16 +1023,18 @@ def run_alphafold(feature_dict, opt=None, runner=None, num_models=5, num_samples
   model_rank = [model_rank[i] for i in np.argsort([outs[x][rank_by] for x in model_rank])[::-1]]
 
   # Write out the prediction
+  ranked_pdbs = []
   for n,key in enumerate(model_rank):
     prefix = f"rank_{n+1}_{key}" 
     pred_output_path = os.path.join(feature_dict["output_dir"],f'{prefix}_unrelaxed.pdb')
     fig = cf.plot_protein(outs[key]["unrelaxed_protein"], Ls=feature_dict["Ls"], dpi=200)
     plt.savefig(os.path.join(feature_dict["output_dir"],f'{prefix}.png'), bbox_inches = 'tight')
     plt.close(fig)
-    pdb_lines = protein.to_pdb(outs[key]["unrelaxed_protein"])
-    with open(pred_output_path, 'w') as f:
-      f.write(pdb_lines)
-    
+    ranked_pdbs.append((pred_output_path, protein.to_pdb(outs[key]["unrelaxed_protein"])))
+  write_pdbs(ranked_pdbs)
+
+  # the unranked pdbs are only removed once all ranked ones are written
+  for key in model_rank:
     tmp_pdb_path = os.path.join(feature_dict["output_dir"],f'unranked_{key}_unrelaxed.pdb')
     if os.path.isfile(tmp_pdb_path):
       os.remove(tmp_pdb_path)
@@ -0,0 +1,154 @@
+import random
+import re
+import shutil
+
+import numpy as np
+import pytest
+from alphafold.common import residue_constants
+
+from colabfold.colabfold_alphafold import (
+    _clean_homooligomer,
+    _clean_sequence,
+    _clean_trim,
+    _filter_redundant,
+    _hhfilter,
+    _make_msa_features,
+    _msa_to_array,
+)
+
+
+def _clean_reference(sequence, homooligomer, trim):
+    """The original chain of re.sub calls from prep_inputs and prep_filter"""
+    sequence = re.sub("[^A-Z:/]", "", sequence.upper())
+    sequence = re.sub(":+", ":", sequence)
+    sequence = re.sub("/+", "/", sequence)
+    sequence = re.sub("^[:/]+", "", sequence)
+    sequence = re.sub("[:/]+$", "", sequence)
+    homooligomer = re.sub("[:/]+", ":", homooligomer)
+    homooligomer = re.sub("^[:/]+", "", homooligomer)
+    homooligomer = re.sub("[:/]+$", "", homooligomer)
+    if len(homooligomer) == 0:
+        homooligomer = "1"
+    homooligomer = re.sub("[^0-9:]", "", homooligomer)
+    trim = re.sub("[^0-9A-Z,-]", "", trim.upper())
+    trim = re.sub(",+", ",", trim)
+    trim = re.sub("^[,]+", "", trim)
+    trim = re.sub("[,]+$", "", trim)
+    return sequence, homooligomer, trim
+
+
+@pytest.mark.parametrize(
+    "sequence,homooligomer,trim",
+    [
+        ("PIAQIHILEGRSDEQK:/:MSTAV//KQ:", "2:\n", ",A1-10,,\n"),
+        ("::abc::\n", "/:1/2:\n", "b5-\n"),
+        ("", "", ""),
+        ("\n:", ":\n", ",\n"),
+    ],
+)
+def test_clean_inputs_edge_cases(sequence, homooligomer, trim):
+    assert (
+        _clean_sequence(sequence),
+        _clean_homooligomer(homooligomer),
+        _clean_trim(trim),
+    ) == _clean_reference(sequence, homooligomer, trim)
+
+
+def test_clean_inputs_random():
+    rng = random.Random(0)
+    alphabet = "Ab:/ x12,-\n\t"
+    for _ in range(10000):
+        sequence, homooligomer, trim = (
+            "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 8)))
+            for _ in range(3)
+        )
+        assert (
+            _clean_sequence(sequence),
+            _clean_homooligomer(homooligomer),
+            _clean_trim(trim),
+        ) == _clean_reference(sequence, homooligomer, trim)
+
+
+# Stitched pair rows and the indices `hhfilter -id 90` keeps for them
+HHFILTER_ROWS = [
+    "ACDEFGHIKLMNPQRSTVWY",  # query
+    "ACDEFGHIKLMNPQRSTVWY",  # exact duplicate of the query
+    "ACDWFGHIKLMWPQRSTVWY",  # exactly 90% identical, kept
+    "ACDEFGHWKLMNPQRSTVWY",  # 95% identical
+    "ACDEFGHIKL----------",  # identical over its own residues
+    "PCPEPGPIPLPNGQPSPVPY",  # 50% identical, kept
+    "-----RQPNMLKIHGFEDCA",  # shorter copy of the next row
+    "YWVTSRQPNMLKIHGFEDCA",  # unrelated, kept instead of its shorter copy
+]
+HHFILTER_KEPT = [0, 2, 5, 7]
+
+
+def test_filter_redundant():
+    assert _filter_redundant(HHFILTER_ROWS, seq_id=0.9) == HHFILTER_KEPT
+    # the block size only changes how many kept rows are compared at once
+    assert _filter_redundant(HHFILTER_ROWS, seq_id=0.9, block=1) == HHFILTER_KEPT
+    assert _filter_redundant([]) == []
+
+
+@pytest.mark.skipif(shutil.which("hhfilter") is None, reason="hhfilter not installed")
+def test_filter_redundant_matches_hhfilter():
+    assert _hhfilter(HHFILTER_ROWS, "hhfilter", seq_id=90) == HHFILTER_KEPT
+
+
+MSAS = [
+    ["ACDEFGHIKL", "ACD-FGHIKL", "BJOUZXACDE"],
+    ["ACDEFGHIKL", "----FGHIKL", "ACD-FGHIKL", "WYWYWYWYWY"],
+]
+DELETION_MATRICES = [
+    [[0] * 10, [0, 0, 1, 0, 0, 0, 0, 0, 0, 0], [0] * 10],
+    [[0] * 10, [0, 0, 0, 0, 3, 0, 0, 0, 0, 0], [0] * 10, [2] * 10],
+]
+
+
+def _make_msa_features_reference(msas, deletion_matrices):
+    """pipeline.make_msa_features from alphafold 2.0, which deduplicates across msas"""
+    int_msa, deletion_matrix, seen_sequences = [], [], set()
+    for msa_index, msa in enumerate(msas):
+        for sequence_index, sequence in enumerate(msa):
+            if sequence in seen_sequences:
+                continue
+            seen_sequences.add(sequence)
+            int_msa.append(
+                [residue_constants.HHBLITS_AA_TO_ID[res] for res in sequence]
+            )
+            deletion_matrix.append(deletion_matrices[msa_index][sequence_index])
+    num_res = len(msas[0][0])
+    return {
+        "deletion_matrix_int": np.array(deletion_matrix, dtype=np.int32),
+        "msa": np.array(int_msa, dtype=np.int32),
+        "num_alignments": np.array([len(int_msa)] * num_res, dtype=np.int32),
+    }
+
+
+def test_make_msa_features_matches_reference():
+    expected = _make_msa_features_reference(MSAS, DELETION_MATRICES)
+    actual = _make_msa_features(MSAS, DELETION_MATRICES)
+    for k in ["msa", "deletion_matrix_int", "num_alignments"]:
+        np.testing.assert_array_equal(actual[k], expected[k])
+        assert actual[k].dtype == expected[k].dtype
+    # the repeated query and ACD-FGHIKL rows of the second msa are dropped
+    assert actual["msa"].shape == (5, 10)
+    np.testing.assert_array_equal(actual["num_alignments"], [5] * 10)
+    np.testing.assert_array_equal(actual["msa"][2, :6], [2, 20, 20, 1, 3, 20])
+    np.testing.assert_array_equal(
+        actual["deletion_matrix_int"][3], [0, 0, 0, 0, 3] + [0] * 5
+    )
+
+
+def test_make_msa_features_errors():
+    with pytest.raises(ValueError, match="deletion matrix rows"):
+        _make_msa_features(MSAS, [DELETION_MATRICES[0], DELETION_MATRICES[1][:2]])
+    with pytest.raises(ValueError, match="unknown residues"):
+        _make_msa_features([["ACDEF", "acd*F"]], [[[0] * 5, [0] * 5]])
+
+
+def test_msa_to_array_rejects_ragged_rows():
+    assert _msa_to_array(["AC-", "ACD"]).shape == (2, 3)
+    # 2 + 4 residues would reshape to [2,3] without the length check
+    with pytest.raises(ValueError, match="same length"):
+        _msa_to_array(["AC", "ACDE"])